@@ -0,0 +1,385 @@
+#!/usr/bin/env python3
+
+# Re-drive traffic captured by rps-websocket-server.py (see the [capture]
+# section of conf.ini) against a server, and compare latency and throughput
+# with the recorded run.
+#
+# Each captured connection is replayed as a client. Before sending an
+# inbound frame, the client waits until it has received as many frames as
+# the server had sent on that connection at the time of recording, then
+# waits out the recorded think time (scaled by --speed; skipped at max
+# speed). It then also waits for the frames recorded before it on other
+# connections, inbound ones to be sent and outbound ones to be received,
+# so that e.g. a challenge does not overtake the logon of the user
+# challenged. Run the target server with the --seed recorded in the capture so
+# that bot games are reproduced. Every frame received is checked against the
+# recording as it arrives; a connection whose replay diverges (an unexpected
+# frame, a different turn result, or a frame missing for --frame-timeout) is
+# abandoned and left out of the comparison.
+#
+# uids are handed out afresh by the server, so recorded uids in challenge
+# and accept frames are rewritten to the ones handed out during replay, as
+# learned from logon and challenged frames.
+
+import argparse
+import asyncio
+import json
+import signal
+import statistics
+import sys
+import time
+
+import websockets
+
+
+def sigint_handler(signal, frame):
+    print('Interrupted.', file=sys.stderr)
+    sys.exit(0)
+
+
+signal.signal(signal.SIGINT, sigint_handler)
+
+ev = asyncio.get_event_loop()
+
+
+class Connection(object):
+    def __init__(self, conn_id):
+        self.conn_id = conn_id
+        self.opened = None
+        self.closed = None
+        self.seed = None  # Server seed for bot randomness
+        # List of (timestamp, frame, number of outbound frames before it)
+        self.inbound = []
+        self.outbound = []  # List of timestamps
+        self.outbound_frames = []
+        # Positions of inbound frames among all inbound frames of the
+        # capture, and the number of outbound frames of the capture before
+        # each; positions of outbound frames among all outbound frames
+        self.inbound_seqs = []
+        self.inbound_frontiers = []
+        self.outbound_seqs = []
+
+        # Results of the replay
+        self.diverged = False
+        self.replay_opened = None
+        self.replay_closed = None
+        self.replayed_frames = 0
+        self.replayed_latencies = []
+
+    # Time spanned by the recording of the connection
+    def recorded_span(self):
+        return self.opened, max([self.closed or self.opened] +
+                                [t for t, _, _ in self.inbound] + self.outbound)
+
+    # Recorded time from each inbound frame to the next outbound frame,
+    # for inbound frames that were answered before the next inbound frame.
+    def recorded_latencies(self):
+        latencies = []
+        for i, (t, _, seen) in enumerate(self.inbound):
+            if seen >= len(self.outbound):
+                continue
+            if i + 1 < len(self.inbound) and self.inbound[i + 1][2] == seen:
+                continue
+            latencies.append(self.outbound[seen] - t)
+        return latencies
+
+
+# Capture files may be given in any order (e.g., capture.jsonl.2,
+# capture.jsonl.1, capture.jsonl); records are sorted by timestamp.
+# Timestamps are only comparable within a single server run.
+def load_capture(paths):
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as fp:
+            for line in fp:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f'{path}: cannot decode as JSON, ignored: {line}', file=sys.stderr)
+    records.sort(key=lambda r: r['t'])
+
+    connections = {}
+    for record in records:
+        conn_id = record.get('conn')
+        if conn_id is None:
+            continue
+        conn = connections.get(conn_id)
+        if conn is None:
+            conn = connections[conn_id] = Connection(conn_id)
+        direction = record['dir']
+        if direction == 'open':
+            conn.opened = record['t']
+            conn.seed = record.get('seed')
+        elif direction == 'close':
+            conn.closed = record['t']
+        elif direction == 'in':
+            conn.inbound.append((record['t'], record['frame'], len(conn.outbound)))
+        elif direction == 'out':
+            conn.outbound.append(record['t'])
+            conn.outbound_frames.append(record['frame'])
+
+    # Connections whose opening was rotated away cannot be replayed
+    # faithfully, since their logon is missing
+    connections = [conn for conn in connections.values() if conn.opened is not None]
+
+    # Number the frames of the remaining connections in order
+    events = sorted([(t, 'in', conn.conn_id, conn) for conn in connections
+                     for t, _, _ in conn.inbound] +
+                    [(t, 'out', conn.conn_id, conn) for conn in connections
+                     for t in conn.outbound])
+    inbound_seq = outbound_seq = 0
+    for _, direction, _, conn in events:
+        if direction == 'in':
+            conn.inbound_seqs.append(inbound_seq)
+            conn.inbound_frontiers.append(outbound_seq)
+            inbound_seq += 1
+        else:
+            conn.outbound_seqs.append(outbound_seq)
+            outbound_seq += 1
+    return connections
+
+
+# Tracks the frames of a capture in one direction that have been replayed
+# (or skipped, for a diverged connection), so that frames can be replayed
+# in their recorded order across connections
+class Sequencer(object):
+    def __init__(self):
+        self.next = 0  # Position of the first frame not yet replayed
+        self.done = set()  # Positions replayed, beyond next
+        self.advanced = asyncio.Event()
+
+    async def wait_for(self, seq):
+        while self.next < seq:
+            self.advanced.clear()
+            await self.advanced.wait()
+
+    # Mark frames as replayed, or as skipped for a diverged connection
+    def release(self, seqs):
+        self.done.update(seq for seq in seqs if seq >= self.next)
+        while self.next in self.done:
+            self.done.discard(self.next)
+            self.next += 1
+        self.advanced.set()
+
+
+# Whether a frame received during replay matches the recorded one. Turn
+# results must match exactly; other frames only need the same action,
+# since e.g. uids differ between runs.
+def frames_match(recorded, replayed):
+    try:
+        recorded = json.loads(recorded)
+        replayed = json.loads(replayed)
+    except json.JSONDecodeError:
+        return recorded == replayed
+    if recorded.get('action') == 'endturn':
+        return recorded == replayed
+    return recorded.get('action') == replayed.get('action')
+
+
+# Learn the replayed uid corresponding to a recorded one, from a logon or
+# challenged frame
+def learn_uid(uid_map, recorded, replayed):
+    try:
+        recorded = json.loads(recorded)
+        replayed = json.loads(replayed)
+    except json.JSONDecodeError:
+        return
+    if recorded.get('action') in ['logon', 'challenged'] and 'uid' in recorded:
+        uid_map[recorded['uid']] = replayed.get('uid')
+
+
+# Rewrite recorded uids in an inbound frame to their replayed counterparts
+def rewrite_uids(uid_map, frame):
+    try:
+        msg = json.loads(frame)
+    except json.JSONDecodeError:
+        return frame
+    if (isinstance(msg, dict) and msg.get('action') in ['challenge', 'accept'] and
+            isinstance(msg.get('opponent'), str) and msg['opponent'] in uid_map):
+        msg['opponent'] = uid_map[msg['opponent']]
+        return json.dumps(msg)
+    return frame
+
+
+async def replay_connection(url, conn, t0, start, speed, frame_timeout, uid_map,
+                            sent_frames, received_frames):
+    def scaled(seconds):
+        return 0 if speed is None else seconds / speed
+
+    await asyncio.sleep(max(0, scaled(conn.opened - t0) - (time.monotonic() - start)))
+
+    conn.replay_opened = time.monotonic()
+    ws = await websockets.connect(url)
+    received = []  # Timestamps of frames received
+    arrival = asyncio.Event()
+
+    # Check each frame against the recording as it arrives
+    async def reader():
+        try:
+            while not conn.diverged:
+                frame = await ws.recv()
+                i = len(received)
+                received.append(time.monotonic())
+                conn.replayed_frames += 1
+                if i >= len(conn.outbound_frames):
+                    conn.diverged = True
+                elif not frames_match(conn.outbound_frames[i], frame):
+                    conn.diverged = True
+                else:
+                    learn_uid(uid_map, conn.outbound_frames[i], frame)
+                    received_frames.release([conn.outbound_seqs[i]])
+                arrival.set()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def wait_for_received(count):
+        while len(received) < count and not conn.diverged:
+            arrival.clear()
+            await arrival.wait()
+
+    # Returns False if the replay has diverged from the recording (e.g.,
+    # paired with a different opponent, or a bot played differently)
+    async def catch_up(count):
+        try:
+            await asyncio.wait_for(wait_for_received(count), timeout=frame_timeout)
+        except asyncio.TimeoutError:
+            conn.diverged = True
+        return not conn.diverged
+
+    reader_task = asyncio.ensure_future(reader(), loop=ev)
+    sent = []  # (timestamp, number of frames received before it)
+    try:
+        for i, (t, frame, seen) in enumerate(conn.inbound):
+            if not await catch_up(seen):
+                break
+            if seen > 0:
+                think_time = t - conn.outbound[seen - 1]
+                await asyncio.sleep(max(0, scaled(think_time)))
+            await received_frames.wait_for(conn.inbound_frontiers[i])
+            await sent_frames.wait_for(conn.inbound_seqs[i])
+            sent.append((time.monotonic(), len(received)))
+            await ws.send(rewrite_uids(uid_map, frame))
+            conn.replayed_frames += 1
+            sent_frames.release([conn.inbound_seqs[i]])
+        else:
+            await catch_up(len(conn.outbound))
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        # Do not hold up other connections with frames never to be replayed
+        sent_frames.release(conn.inbound_seqs)
+        received_frames.release(conn.outbound_seqs)
+        await ws.close()
+        reader_task.cancel()
+        conn.replay_closed = time.monotonic()
+
+    if conn.diverged:
+        return
+
+    for i, (t, seen) in enumerate(sent):
+        if seen >= len(received):
+            continue
+        if i + 1 < len(sent) and sent[i + 1][1] == seen:
+            continue
+        conn.replayed_latencies.append(received[seen] - t)
+
+
+def summarize(label, latencies, frames, duration):
+    line = f'{label:>9}: {frames} frames in {duration:.3f} s'
+    if duration > 0:
+        line += f' ({frames / duration:.1f} frames/s)'
+    if latencies:
+        latencies = sorted(latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+
+        line += (f'; latency ms: mean {statistics.mean(latencies) * 1000:.2f}, '
+                 f'p50 {percentile(50):.2f}, p90 {percentile(90):.2f}, '
+                 f'p99 {percentile(99):.2f}, max {latencies[-1] * 1000:.2f}')
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured traffic against a server.')
+    parser.add_argument('captures', nargs='+', metavar='CAPTURE',
+                        help='capture files, including any rotated ones')
+    parser.add_argument('-u', '--url', default='ws://localhost:8080',
+                        help='server to replay against (default: %(default)s)')
+    parser.add_argument('-s', '--speed', default='1',
+                        help='speedup factor, or "max" to ignore recorded timing (default: 1)')
+    parser.add_argument('--frame-timeout', type=float, default=15,
+                        help='seconds to wait for an expected server frame (default: 15)')
+    args = parser.parse_args()
+
+    if args.speed == 'max':
+        speed = None
+    else:
+        try:
+            speed = float(args.speed)
+        except ValueError:
+            parser.error(f'invalid speed: {args.speed}')
+        if speed <= 0:
+            parser.error(f'invalid speed: {args.speed}')
+
+    connections = load_capture(args.captures)
+    if not connections:
+        print('no replayable connections in capture', file=sys.stderr)
+        sys.exit(1)
+
+    seeds = {conn.seed for conn in connections}
+    if seeds == {None}:
+        print('warning: capture has no bot seed; bot games will diverge', file=sys.stderr)
+    else:
+        recorded_seeds = ', '.join(str(seed) for seed in seeds if seed is not None)
+        print(f'recorded with bot seed(s) {recorded_seeds}; '
+              f'the server should run with the same --seed')
+
+    t0 = min(conn.opened for conn in connections)
+    uid_map = {}  # Recorded uid -> replayed uid
+    sent_frames = Sequencer()
+    received_frames = Sequencer()
+    start = time.monotonic()
+    ev.run_until_complete(asyncio.gather(*[
+        replay_connection(args.url, conn, t0, start, speed, args.frame_timeout,
+                          uid_map, sent_frames, received_frames)
+        for conn in connections
+    ]))
+
+    print(f'{len(connections)} connections replayed at '
+          f'{"max speed" if speed is None else f"{speed:g}x"}')
+
+    # Compare only connections replayed faithfully, over the time they span
+    # in either run
+    faithful = [conn for conn in connections if not conn.diverged]
+    diverged = len(connections) - len(faithful)
+    if diverged:
+        print(f'warning: {diverged} connection(s) diverged from the recording '
+              f'and were left out of the comparison')
+    if not faithful:
+        sys.exit(1)
+
+    spans = [conn.recorded_span() for conn in faithful]
+    recorded_duration = max(end for _, end in spans) - min(begin for begin, _ in spans)
+    recorded_latencies = [latency for conn in faithful
+                          for latency in conn.recorded_latencies()]
+    recorded_frames = sum(len(conn.inbound) + len(conn.outbound) for conn in faithful)
+    replayed_duration = (max(conn.replay_closed for conn in faithful) -
+                         min(conn.replay_opened for conn in faithful))
+    replayed_latencies = [latency for conn in faithful
+                          for latency in conn.replayed_latencies]
+    replayed_frames = sum(conn.replayed_frames for conn in faithful)
+
+    summarize('recorded', recorded_latencies, recorded_frames, recorded_duration)
+    summarize('replayed', replayed_latencies, replayed_frames, replayed_duration)
+    if recorded_latencies and replayed_latencies:
+        delta = (statistics.median(replayed_latencies) /
+                 statistics.median(recorded_latencies) - 1)
+        print(f'median latency change: {delta * 100:+.1f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,18 +2,22 @@
 
 import argparse
 import asyncio
+import atexit
 import configparser
 import enum
+import itertools
 import json
 import logging
+import logging.handlers
 import os
+import queue
 import signal
 import ssl
 import sys
 import time
-import uuid
-from random import SystemRandom
+from random import Random, SystemRandom
 # Use random.SystemRandom as generator to make bot moves unguessable
+# (unless a seed is given, for replays; see spawn_bot)
 random = SystemRandom()
 
 import websockets
@@ -48,6 +52,62 @@ ENABLE_SSL = CONFIG.getboolean('ssl', 'enable_ssl', fallback=False)
 CERTFILE = CONFIG.get('ssl', 'certfile', fallback='')
 KEYFILE = CONFIG.get('ssl', 'keyfile', fallback=None)
 PORT = CONFIG.getint('server', 'port', fallback=8443 if ENABLE_SSL else 8080)
+MOVE_TIMEOUT = CONFIG.getfloat('game', 'move_timeout', fallback=10.5)
+TURN_INTERVAL = CONFIG.getfloat('game', 'turn_interval', fallback=2)
+ENDGAME_DELAY = CONFIG.getfloat('game', 'endgame_delay', fallback=0.5)
+ALLOW_FAST_MODE = CONFIG.getboolean('game', 'allow_fast_mode', fallback=True)
+# Seed for bot randomness; set by --seed, or picked at random when
+# capturing traffic so that captures can be replayed deterministically.
+SEED = None
+ENABLE_CAPTURE = CONFIG.getboolean('capture', 'enable_capture', fallback=False)
+CAPTURE_FILE = os.path.join(HERE, CONFIG.get('capture', 'capture_file', fallback='capture.jsonl'))
+CAPTURE_MAX_BYTES = CONFIG.getint('capture', 'max_bytes', fallback=10 * 1024 * 1024)
+CAPTURE_BACKUP_COUNT = CONFIG.getint('capture', 'backup_count', fallback=5)
+NO_SHOW_TIMEOUT = CONFIG.getfloat('tournament', 'no_show_timeout', fallback=60)
+
+# Traffic capture: one JSON object per line, with a monotonic timestamp,
+# a connection id, a direction ('open', 'in', 'out' or 'close') and, for
+# 'in' and 'out', the raw frame. Consumed by rps-replay.py.
+# Records are handed over to a listener thread, which does the (blocking)
+# file writes and rotation away from the event loop.
+capture_logger = logging.getLogger('rps.capture')
+capture_logger.propagate = False
+capture_logger.disabled = True
+capture_conn_ids = {}
+capture_conn_counter = itertools.count(1)
+
+
+def setup_capture():
+    handler = logging.handlers.RotatingFileHandler(
+        CAPTURE_FILE, maxBytes=CAPTURE_MAX_BYTES, backupCount=CAPTURE_BACKUP_COUNT,
+        encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    capture_queue = queue.Queue()
+    listener = logging.handlers.QueueListener(capture_queue, handler)
+    listener.start()
+    # Flush pending records on exit (including sys.exit from sigint_handler)
+    atexit.register(listener.stop)
+    capture_logger.addHandler(logging.handlers.QueueHandler(capture_queue))
+    capture_logger.setLevel(logging.INFO)
+    capture_logger.disabled = False
+    logger.info(f'capturing traffic to {CAPTURE_FILE}')
+
+
+def capture_frame(ws, direction, frame=None, extra=None):
+    if capture_logger.disabled:
+        return
+    record = {
+        't': round(time.monotonic(), 6),
+        'conn': capture_conn_ids.get(ws),
+        'dir': direction,
+    }
+    if extra is not None:
+        record.update(extra)
+    if frame is not None:
+        if isinstance(frame, bytes):
+            frame = frame.decode('utf-8', 'replace')
+        record['frame'] = frame
+    capture_logger.info(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
 
 
 class User(object):
@@ -57,11 +117,23 @@ class User(object):
         self.uid = uid
         self.name = name
         self.affiliation = affiliation
+        self.bots_spawned = 0
+        self.random = random  # Generator for bot names and moves
+        # In fast mode the next turn starts as soon as the client
+        # acknowledges the result, instead of after TURN_INTERVAL
+        self.fast = False
 
         self.queue = asyncio.Queue()
         self.opponent = None
         self.game = None
-
+        self.tournament = None
+
+        self.standing_by = False  # True while waiting to be paired
+        # True while standing by for challenges (or a tournament) only,
+        # withheld from the matchmaker
+        self.lobby = False
+        self.challengers = set()  # uids of users who challenged us
+        self.notices = []  # Messages deferred until the user stands by
         self.dropped = False  # Set to True at the end of user session
 
     def __eq__(self, other):
@@ -73,6 +145,15 @@ class User(object):
     def __str__(self):
         return f'{self.uid} "{self.name}"'
 
+    # Whether the user may be paired by a challenge. (opponent may still be
+    # set after a surrender, until the judge has settled the game.)
+    def available(self):
+        return self.standing_by and self.tournament is None
+
+    # Whether the user may be paired by the matchmaker
+    def matchable(self):
+        return self.available() and not self.lobby
+
 
 class Gesture(enum.Enum):
     ROCK = 0
@@ -126,6 +207,7 @@ class Game(object):
         self.winner = None
         self.special = None  # 'leave', 'surrender'
         self.turns = []
+        self.match = None  # Tournament Match, if any
 
     def __str__(self):
         return f'{self.user1} {self.score1} - {self.score2} {self.user2}'
@@ -158,8 +240,54 @@ class Game(object):
             logger.info(f'{self.winner} won')
 
 
+# Registry of logged on (human) users, indexed by uid, with a secondary
+# index by name. Names are not unique, so the name index maps each name to
+# a dict of uid -> User.
+class UserRegistry(object):
+    def __init__(self):
+        self._by_uid = {}
+        self._by_name = {}
+
+    def add(self, user):
+        self._by_uid[user.uid] = user
+        self._by_name.setdefault(user.name, {})[user.uid] = user
+
+    def remove(self, user):
+        if self._by_uid.pop(user.uid, None) is None:
+            return
+        namesakes = self._by_name.get(user.name)
+        if namesakes is not None:
+            namesakes.pop(user.uid, None)
+            if not namesakes:
+                del self._by_name[user.name]
+
+    def get(self, uid):
+        return self._by_uid.get(uid)
+
+    def get_by_name(self, name):
+        return list(self._by_name.get(name, {}).values())
+
+    # Look up a user by uid, or failing that, by name. Returns None if
+    # nobody matches, or if the name is ambiguous.
+    def lookup(self, uid_or_name):
+        user = self.get(uid_or_name)
+        if user is not None:
+            return user
+        namesakes = self.get_by_name(uid_or_name)
+        if len(namesakes) == 1:
+            return namesakes[0]
+        return None
+
+
+registry = UserRegistry()
+
+# uids are drawn from a process-wide counter, so they never collide within
+# the lifetime of the server.
+uid_counter = itertools.count(1)
+
+
 def generate_uid():
-    return uuid.uuid1().hex[:7].upper()
+    return f'{next(uid_counter):07X}'
 
 
 # Returns None is connection closes.
@@ -194,6 +322,8 @@ async def wait_for_message(ws, expected_action,
             logger.debug(f'{msg_prefix}expected action "{expected_action}" timed out')
             return {}
 
+        capture_frame(ws, 'in', resp)
+
         try:
             resp = json.loads(resp)
         except json.JSONDecodeError:
@@ -240,11 +370,13 @@ async def wait_for_message(ws, expected_action,
 async def send_message(ws, obj, raise_exceptions=True, timeout=None, msg_prefix=None):
     msg_prefix = '' if msg_prefix is None else f'{msg_prefix}: '
 
+    msg = json.dumps(obj)
     try:
         if timeout is not None:
-            await asyncio.wait_for(ws.send(), timeout=timeout)
+            await asyncio.wait_for(ws.send(msg), timeout=timeout)
         else:
-            await ws.send(json.dumps(obj))
+            await ws.send(msg)
+        capture_frame(ws, 'out', msg)
         return True
     except websockets.exceptions.ConnectionClosed:
         logger.info(f'{msg_prefix}connection closed')
@@ -324,10 +456,92 @@ async def user_session_logon(ws):
         name = name.encode('utf-8')[:16].decode('utf-8', 'ignore')
 
     me = User(uid, name)
-    logger.info(f'user {me} logged on')
+    me.fast = ALLOW_FAST_MODE and resp.get('fast') is True
+    registry.add(me)
+    logger.info(f'user {me} logged on' + (' (fast mode)' if me.fast else ''))
+    try:
+        await send_message(ws, {
+            'action': 'logon',
+            'uid': uid,
+            'fast': me.fast,
+        }, msg_prefix=me)
+    except websockets.exceptions.ConnectionClosed:
+        registry.remove(me)
+        return None
     return me
 
 
+def pair_users(u1, u2):
+    u1.opponent = u2
+    u2.opponent = u1
+    game = Game(u1, u2)
+    u1.game = game
+    u2.game = game
+    for user in [u1, u2]:
+        user.standing_by = False
+        user.challengers.clear()
+
+
+# Challenge a specific user, identified by uid or name. The challenged user
+# is notified through their command queue and may respond with an accept
+# message.
+async def user_session_challenge(ws, me, target):
+    if not isinstance(target, str) or not target:
+        reason = 'invalid opponent'
+    else:
+        them = registry.lookup(target)
+        if them is None:
+            reason = 'not found'
+        elif them == me:
+            reason = 'self'
+        elif not them.available() or not me.available():
+            reason = 'unavailable'
+        else:
+            reason = None
+
+    if reason is not None:
+        logger.info(f'{me}: challenge to "{target}" failed: {reason}')
+        await send_message(ws, {
+            'action': 'challenge_failed',
+            'opponent': target,
+            'reason': reason,
+        }, raise_exceptions=False, msg_prefix=me)
+        return
+
+    them.challengers.add(me.uid)
+    await them.queue.put({'action': 'challenged', 'challenger': me})
+    logger.info(f'{me} challenged {them}')
+
+
+# Accept a challenge from the user with the given uid; the two users are
+# paired directly, bypassing the matchmaker.
+async def user_session_accept(ws, me, challenger_uid):
+    if not isinstance(challenger_uid, str) or not challenger_uid:
+        reason = 'invalid opponent'
+    else:
+        them = registry.get(challenger_uid)
+        if (them is None or challenger_uid not in me.challengers or
+                not them.available() or not me.available()):
+            me.challengers.discard(challenger_uid)
+            reason = 'unavailable'
+        else:
+            reason = None
+
+    if reason is not None:
+        logger.info(f'{me}: cannot accept challenge from {challenger_uid}: {reason}')
+        await send_message(ws, {
+            'action': 'challenge_failed',
+            'opponent': challenger_uid,
+            'reason': reason,
+        }, raise_exceptions=False, msg_prefix=me)
+        return
+
+    pair_users(them, me)
+    await them.queue.put({'action': 'match', 'opponent': me})
+    await me.queue.put({'action': 'match', 'opponent': them})
+    logger.info(f'challenge accepted: {them} and {me}')
+
+
 # Returns True if successfully paired;
 # Otherwise (connection dropped at some point), returns False.
 async def user_session_wait_for_opponent(ws, me):
@@ -339,39 +553,81 @@ async def user_session_wait_for_opponent(ws, me):
     if resp is None:
         return False
 
-    async def listen_for_bot_request():
-        resp = await wait_for_message(
-            ws, 'bot_request',
-            msg_prefix=me,
-        )
-        if resp is None:
-            return False
-        # Request a bot
-        await matchmaker_queue.put((me, True))
-
-    await matchmaker_queue.put((me, False))  # Request a human
-    bot_request_listener = asyncio.ensure_future(listen_for_bot_request(), loop=ev)
+    async def listen_for_requests():
+        while True:
+            resp = await wait_for_message(
+                ws, 'bot_request',
+                interrupters=['challenge', 'accept', 'tournament_create',
+                              'tournament_join', 'tournament_start'],
+                msg_prefix=me,
+            )
+            if resp is None:
+                # Wake up the session, which may otherwise wait forever
+                # (e.g. in the lobby, where nobody livechecks it)
+                await me.queue.put({'action': 'closed'})
+                return False
+            if resp['action'].startswith('tournament_'):
+                await user_session_tournament(ws, me, resp)
+            elif resp['action'] == 'challenge':
+                await user_session_challenge(ws, me, resp.get('opponent'))
+            elif resp['action'] == 'accept':
+                await user_session_accept(ws, me, resp.get('opponent'))
+            else:
+                # Request a bot, leaving the lobby if need be
+                me.lobby = False
+                await matchmaker_queue.put((me, True))
+
+    me.standing_by = True
+    me.lobby = resp.get('lobby') is True
+    for message in me.notices:
+        me.queue.put_nowait({'action': 'notify', 'message': message})
+    me.notices.clear()
+    if me.tournament is not None:
+        me.tournament.ready(me)
+    elif not me.lobby:
+        await matchmaker_queue.put((me, False))  # Request a human
+    request_listener = asyncio.ensure_future(listen_for_requests(), loop=ev)
 
     while True:
         cmd = await wait_for_command(
             me.queue, 'match',
             validity_test=lambda c: 'opponent' in c,
-            interrupters=['livecheck'],
+            interrupters=['livecheck', 'challenged', 'notify', 'closed'],
             msg_prefix=me,
         )
-        if cmd['action'] == 'livecheck':
+        if cmd['action'] == 'closed':
+            return False
+        elif cmd['action'] == 'notify':
+            try:
+                await send_message(ws, cmd['message'], msg_prefix=me)
+            except websockets.exceptions.ConnectionClosed:
+                request_listener.cancel()
+                return False
+        elif cmd['action'] == 'challenged':
+            challenger = cmd['challenger']
+            try:
+                await send_message(ws, {
+                    'action': 'challenged',
+                    'challenger': challenger.name,
+                    'uid': challenger.uid,
+                }, msg_prefix=me)
+            except websockets.exceptions.ConnectionClosed:
+                request_listener.cancel()
+                return False
+        elif cmd['action'] == 'livecheck':
             try:
                 await ws.ping()
                 await matchmaker_livecheck_queue.put((me, True))
             except websockets.exceptions.ConnectionClosed:
                 logger.info(f'{me}: connection closed')
                 await matchmaker_livecheck_queue.put((me, False))
+                request_listener.cancel()
                 return False
         else:
             break
 
-    # Cancel the bot request listener task if it hasn't finished already
-    bot_request_listener.cancel()
+    # Cancel the request listener task if it hasn't finished already
+    request_listener.cancel()
 
     return True
 
@@ -383,25 +639,36 @@ async def user_session_play_game(ws, me):
 
     # Commence the game
     try:
-        await send_message(ws, {
+        msg = {
             'action': 'match',
             'opponent': them.name,
-        }, msg_prefix=me)
+        }
+        if game.match is not None:
+            msg['tournament'] = game.match.tournament.name
+            msg['round'] = game.match.round
+        await send_message(ws, msg, msg_prefix=me)
     except websockets.exceptions.ConnectionClosed:
         await judge_queue.put((me, 'leave'))
         return False
 
+    # A move for the next turn, or a surrender or quit message, received
+    # while waiting for an ack in fast mode, to be handled in place of the
+    # next move
+    pending = None
     while True:
         # Get a move
         turn = len(game.turns)
-        resp = await wait_for_message(
-            ws, 'move',
-            timeout=10.5,
-            expected_keys=['move', 'turn'],
-            validity_test=lambda r, expected_turn=turn: r['turn'] == expected_turn,
-            interrupters=['surrender', 'quit'],
-            msg_prefix=me,
-        )
+        if pending is not None:
+            resp, pending = pending, None
+        else:
+            resp = await wait_for_message(
+                ws, 'move',
+                timeout=MOVE_TIMEOUT,
+                expected_keys=['move', 'turn'],
+                validity_test=lambda r, expected_turn=turn: r['turn'] == expected_turn,
+                interrupters=['surrender', 'quit'],
+                msg_prefix=me,
+            )
         if resp is None:
             # Connection dropped
             await judge_queue.put((me, 'leave'))
@@ -452,7 +719,8 @@ async def user_session_play_game(ws, me):
 
         if game.winner:
             # If game is called
-            await asyncio.sleep(0.5)
+            if not me.fast:
+                await asyncio.sleep(ENDGAME_DELAY)
             await send_message(ws, {
                 'action': 'endgame',
                 'winner': 'me' if game.winner == me else 'them',
@@ -462,16 +730,46 @@ async def user_session_play_game(ws, me):
             me.opponent = None
             me.game = None
             break
+        elif me.fast:
+            # Start the next turn as soon as the client acknowledges this
+            # round's result, but never later than in normal mode. A move
+            # for the next turn counts as an acknowledgement.
+            resp = await wait_for_message(
+                ws, 'ack',
+                timeout=TURN_INTERVAL,
+                expected_keys=['turn'],
+                validity_test=lambda r, expected_turn=turn: r['turn'] == expected_turn,
+                interrupters=['move', 'surrender', 'quit'],
+                msg_prefix=me,
+            )
+            if resp is None:
+                await judge_queue.put((me, 'leave'))
+                return False
+            elif resp.get('action') == 'move':
+                if 'move' in resp and resp.get('turn') == turn + 1:
+                    pending = resp
+                else:
+                    logger.warning(f'{me}: expecting move for turn {turn + 1}, '
+                                   f'ignored: {resp}')
+            elif resp and resp['action'] != 'ack':
+                pending = resp
         else:
-            # Give clients 2 seconds to show this round's result
-            await asyncio.sleep(2)
+            # Give clients some time to show this round's result
+            await asyncio.sleep(TURN_INTERVAL)
 
     return True
 
 
 async def user_session(ws, path):
+    if not capture_logger.disabled:
+        capture_conn_ids[ws] = next(capture_conn_counter)
+        # The seed is recorded with every connection, so that it survives
+        # rotation of the capture file
+        capture_frame(ws, 'open', extra={'seed': SEED})
+
     me = await user_session_logon(ws)
     if me is None:
+        capture_session_close(ws)
         return
 
     try:
@@ -498,11 +796,27 @@ async def user_session(ws, path):
         # Send a leave message to the judge just to be safe.
         judge_queue.put((me, 'leave'))
     finally:
-        await ws.close()
+        # Take the user out of circulation before the close handshake, during
+        # which they could otherwise still be paired
         me.dropped = True
+        me.standing_by = False
+        registry.remove(me)
+        if me.tournament is not None:
+            me.tournament.withdraw(me)
+        for tournament in list(tournaments.values()):
+            if tournament.organizer == me and not tournament.started:
+                tournament.cancel()
+        await ws.close()
+        capture_session_close(ws)
         logger.info(f'dropped {me}')
 
 
+def capture_session_close(ws):
+    if ws in capture_conn_ids:
+        capture_frame(ws, 'close')
+        del capture_conn_ids[ws]
+
+
 # Spawn a bot to be matched against the given user
 def spawn_bot(user):
     BOTNAMES = [
@@ -542,7 +856,17 @@ def spawn_bot(user):
         'Zeratul',
         'Zurvan',
     ]
-    return User(generate_uid(), random.choice(BOTNAMES), affiliation=user)
+    if SEED is None:
+        rng = random
+    else:
+        # Seed each bot by the user it is spawned for, rather than sharing a
+        # generator, so that bot moves do not depend on how the event loop
+        # interleaves bot sessions
+        user.bots_spawned += 1
+        rng = Random(f'{SEED}:{user.name}:{user.bots_spawned}')
+    bot = User(generate_uid(), rng.choice(BOTNAMES), affiliation=user)
+    bot.random = rng
+    return bot
 
 
 async def bot_session(bot):
@@ -556,7 +880,7 @@ async def bot_session(bot):
             return
 
         while True:
-            move = Gesture(random.randrange(3))
+            move = Gesture(bot.random.randrange(3))
             await judge_queue.put((bot, move))
             await wait_for_command(
                 bot.queue, 'endturn',
@@ -580,6 +904,18 @@ async def matchmaker():
 
         new_user, bot_request = await matchmaker_queue.get()
 
+        # Forget the waiting user if they are no longer matchable, e.g.,
+        # paired directly through a challenge, or dropped; this may have
+        # happened while we were blocked above
+        if waiting is not None and not waiting.matchable():
+            waiting = None
+
+        # Ignore stale requests from users who are no longer matchable
+        if not new_user.matchable():
+            continue
+        if not bot_request and new_user == waiting:
+            continue
+
         on_hold = None
         if bot_request:
             # We put new_user into waiting mode (if not already) and
@@ -613,17 +949,16 @@ async def matchmaker():
                 # assume the connection has dropped
                 live = False
 
-            if not live:
+            if not live or not waiting.matchable():
                 waiting = new_user
                 continue
+            if new_user.affiliation is None and not new_user.matchable():
+                # new_user was paired elsewhere during the livecheck
+                continue
 
             u1 = waiting
             u2 = new_user
-            u1.opponent = u2
-            u2.opponent = u1
-            game = Game(u1, u2)
-            u1.game = game
-            u2.game = game
+            pair_users(u1, u2)
             await u1.queue.put({'action': 'match', 'opponent': u2})
             await u2.queue.put({'action': 'match', 'opponent': u1})
             logger.info(f'match made: {u1} and {u2}')
@@ -667,6 +1002,7 @@ async def judge():
             user.game.special = 'leave'
             outstanding.pop(opponent.uid, None)
             await user.queue.put({'action': 'endgame'})
+            game_ended(user.game)
             continue
 
         if opponent.uid in outstanding:
@@ -693,10 +1029,481 @@ async def judge():
                 game.turn(move1, move2)
                 await u1.queue.put({'action': 'endturn'})
                 await u2.queue.put({'action': 'endturn'})
+            if game.winner is not None:
+                game_ended(game)
         else:
             outstanding[user.uid] = move
 
 
+# Tournaments
+#
+# Players join a tournament while standing by; once the organizer starts
+# it, games are started as soon as both players of a match are standing
+# by, through the usual game/judge path. The judge reports finished games
+# back to the tournament (see game_ended), which immediately moves the
+# players on to their next match. Players who drop, or who fail to show
+# up within NO_SHOW_TIMEOUT, forfeit the way leaving players do.
+
+tournaments = {}  # name -> Tournament
+
+
+# A match between two players of a tournament, which may still be waiting
+# for its second player to be decided.
+class Match(object):
+    def __init__(self, tournament, round_, index=None):
+        self.tournament = tournament
+        self.round = round_
+        self.index = index
+        self.players = []
+        self.game = None
+        self.decided = False
+        self.walkovers = 0  # Knockout only; see KnockoutTournament
+        self.no_shows = []  # Players who forfeited by not showing up
+        self.no_show_timer = None
+
+    def __str__(self):
+        players = ' vs '.join(str(p) for p in self.players)
+        return f'{self.tournament.name} round {self.round}: {players}'
+
+
+# Base class of tournament formats, which provide start_rounds(), to set
+# up the first matches, and advance(match, winner, losers), to move the
+# players of a decided match on. winner is None if neither player showed up.
+class Tournament(object):
+    format = None
+
+    def __init__(self, name, organizer):
+        self.name = name
+        self.organizer = organizer
+        self.players = {}  # uid -> User, in order of joining (seeding)
+        self.started = False
+        self.finished = False
+        self.num_rounds = 0
+        self.remaining = 0  # Players who have not yet completed the tournament
+
+        # Standings, kept incrementally
+        self.points = {}  # uid -> points
+        self.by_points = {}  # points -> set of uids
+
+        self.pending = {}  # uid -> Match the user is due to play next
+
+    def __str__(self):
+        return f'{self.format} tournament "{self.name}"'
+
+    def join(self, user):
+        if self.started or not user.available():
+            return False
+        self.players[user.uid] = user
+        user.tournament = self
+        self.points[user.uid] = 0
+        self.by_points.setdefault(0, set()).add(user.uid)
+        logger.info(f'{user} joined {self}')
+        return True
+
+    def start(self):
+        if self.started or len(self.players) < 2:
+            return False
+        self.started = True
+        self.remaining = len(self.players)
+        logger.info(f'{self} started with {len(self.players)} players')
+        self.start_rounds()
+        return True
+
+    # Called for a player who has left before the tournament starts, or
+    # has otherwise stopped taking part
+    def withdraw(self, user):
+        if not self.started:
+            if self.players.pop(user.uid, None) is not None:
+                self.by_points[self.points.pop(user.uid)].discard(user.uid)
+            user.tournament = None
+            return
+        match = self.pending.get(user.uid)
+        if match is not None:
+            # Mid-game, the judge takes care of this via the usual leave logic
+            if match.game is None:
+                self.try_start(match)
+        else:
+            self.drop_out(user)
+
+    def add_points(self, user, points):
+        old = self.points[user.uid]
+        self.by_points[old].discard(user.uid)
+        if not self.by_points[old]:
+            del self.by_points[old]
+        self.points[user.uid] = old + points
+        self.by_points.setdefault(old + points, set()).add(user.uid)
+
+    # Yields (rank, user, points), best first
+    def standings(self):
+        rank = 1
+        for points in sorted(self.by_points, reverse=True):
+            uids = self.by_points[points]
+            for uid in uids:
+                yield rank, self.players[uid], points
+            rank += len(uids)
+
+    def assign(self, match, user):
+        match.players.append(user)
+        self.pending[user.uid] = match
+        if len(match.players) == 2:
+            match.no_show_timer = ev.call_later(NO_SHOW_TIMEOUT, self.no_show, match)
+        self.try_start(match)
+
+    # Called when a tournament player starts standing by
+    def ready(self, user):
+        match = self.pending.get(user.uid)
+        if match is not None:
+            self.try_start(match)
+
+    def try_start(self, match):
+        if match.decided or match.game is not None or len(match.players) < 2:
+            return
+        u1, u2 = match.players
+        for user, opponent in [(u1, u2), (u2, u1)]:
+            if user.dropped or user.tournament is not self:
+                self.forfeit(match, opponent)
+                return
+        if not (u1.standing_by and u2.standing_by):
+            return
+
+        match.no_show_timer.cancel()
+        pair_users(u1, u2)
+        match.game = u1.game
+        match.game.match = match
+        u1.queue.put_nowait({'action': 'match', 'opponent': u2})
+        u2.queue.put_nowait({'action': 'match', 'opponent': u1})
+        logger.info(f'match made: {match}')
+
+    def no_show(self, match):
+        if match.decided or match.game is not None:
+            return
+        u1, u2 = match.players
+        if not (u1.standing_by or u2.standing_by):
+            logger.info(f'{match}: neither player showed up')
+            match.no_shows = [u1, u2]
+            self.forfeit_both(match)
+            return
+        winner, loser = (u1, u2) if u1.standing_by else (u2, u1)
+        logger.info(f'{match}: {loser} did not show up')
+        match.no_shows = [loser]
+        self.forfeit(match, winner)
+
+    # Decide a match without playing it, recording it as a game the loser
+    # left
+    def forfeit(self, match, winner):
+        u1, u2 = match.players
+        game = Game(u1, u2)
+        game.winner = winner
+        game.special = 'leave'
+        game.match = match
+        self.record(game)
+
+    def forfeit_both(self, match):
+        match.decided = True
+        for user in match.players:
+            self.pending.pop(user.uid, None)
+        self.advance(match, None, list(match.players))
+
+    # Called with each finished game of the tournament
+    def record(self, game):
+        match = game.match
+        if match.decided:
+            return
+        match.decided = True
+        if match.no_show_timer is not None:
+            match.no_show_timer.cancel()
+        winner = game.winner
+        loser = game.user2 if winner == game.user1 else game.user1
+        for user in [winner, loser]:
+            self.pending.pop(user.uid, None)
+        self.add_points(winner, 1)
+        logger.info(f'{match}: {winner} won')
+        self.advance(match, winner, [loser])
+
+    # Take a player out of the remaining rounds
+    def drop_out(self, user):
+        self.pending.pop(user.uid, None)
+        self.release(user)
+
+    # Return a player to the matchmaker
+    def release(self, user):
+        if user.tournament is not self:
+            return
+        self.pending.pop(user.uid, None)
+        user.tournament = None
+        self.remaining -= 1
+        if user.standing_by and not user.dropped:
+            matchmaker_queue.put_nowait((user, False))
+        if self.remaining == 0 and not self.finished:
+            self.finish()
+
+    def finish(self):
+        self.finished = True
+        tournaments.pop(self.name, None)
+        for rank, user, points in self.standings():
+            notify(user, {
+                'action': 'tournament_end',
+                'tournament': self.name,
+                'rank': rank,
+                'points': points,
+                'players': len(self.players),
+            })
+            if rank == 1:
+                logger.info(f'{self}: {user} finished first with {points} points')
+        for user in list(self.players.values()):
+            self.release(user)
+        logger.info(f'{self} finished')
+
+    def cancel(self):
+        logger.info(f'{self} cancelled')
+        tournaments.pop(self.name, None)
+        for user in list(self.players.values()):
+            if user.tournament is self:
+                notify(user, {
+                    'action': 'tournament_end',
+                    'tournament': self.name,
+                    'reason': 'cancelled',
+                })
+                user.tournament = None
+                if user.standing_by and not user.dropped:
+                    matchmaker_queue.put_nowait((user, False))
+        self.finished = True
+
+
+# Single elimination. Players are seeded in order of joining and placed in
+# the usual bracket order (1 vs 8, 4 vs 5, 2 vs 7, 3 vs 6 for eight), so
+# that top seeds meet as late as possible; top seeds get byes if the
+# number of players is not a power of two. The winner of
+# match i in round r plays in match i // 2 of round r + 1 as soon as the
+# other player of that match has been decided. A match short of players
+# because of byes or double no-shows is a walkover.
+class KnockoutTournament(Tournament):
+    format = 'knockout'
+
+    def __init__(self, name, organizer):
+        super().__init__(name, organizer)
+        self.matches = {}  # (round, index) -> Match, for undecided matches
+
+    def get_match(self, round_, index):
+        match = self.matches.get((round_, index))
+        if match is None:
+            match = self.matches[(round_, index)] = Match(self, round_, index)
+        return match
+
+    def start_rounds(self):
+        players = list(self.players.values())
+        size = 2
+        self.num_rounds = 1
+        while size < len(players):
+            size *= 2
+            self.num_rounds += 1
+        # Seeds (1-based) in bracket order, built up by pairing each seed s
+        # of a bracket half the size with 2 * len(order) + 1 - s
+        order = [1]
+        while len(order) < size:
+            order = [seed for s in order for seed in (s, 2 * len(order) + 1 - s)]
+        for i in range(size // 2):
+            match = self.get_match(1, i)
+            top, bottom = order[2 * i], order[2 * i + 1]
+            self.assign(match, players[top - 1])
+            if bottom <= len(players):
+                self.assign(match, players[bottom - 1])
+            else:
+                # Bye
+                match.walkovers = 1
+                self.walkover(match)
+
+    def advance(self, match, winner, losers):
+        self.matches.pop((match.round, match.index), None)
+        for loser in losers:
+            self.release(loser)
+        if match.round == self.num_rounds:
+            if winner is not None:
+                self.release(winner)
+            return
+        next_match = self.get_match(match.round + 1, match.index // 2)
+        if winner is None:
+            next_match.walkovers += 1
+        else:
+            self.assign(next_match, winner)
+        if len(next_match.players) < 2 and len(next_match.players) + next_match.walkovers == 2:
+            self.walkover(next_match)
+
+    # Decide a match with fewer than two players, the sole player (if any)
+    # winning without playing
+    def walkover(self, match):
+        match.decided = True
+        if not match.players:
+            self.advance(match, None, [])
+            return
+        winner = match.players[0]
+        self.pending.pop(winner.uid, None)
+        self.add_points(winner, 1)
+        logger.info(f'{match}: {winner} advances by walkover')
+        self.advance(match, winner, [])
+
+
+# Swiss system, with a fixed number of rounds (by default enough to
+# determine a single winner). Rather than waiting for a whole round to
+# finish, a player entering a round is paired right away with a waiting
+# player on the same points they have not played yet. Once every player
+# has entered a round, those still waiting are paired in order of points,
+# and any odd one out gets a bye worth a win.
+class SwissTournament(Tournament):
+    format = 'swiss'
+
+    def __init__(self, name, organizer, rounds=None):
+        super().__init__(name, organizer)
+        self.rounds = rounds
+        self.played = {}  # uid -> set of uids played
+        self.round_of = {}  # uid -> round the user is currently in
+        self.waiting = {}  # round -> points -> list of waiting users
+        self.unentered = {}  # round -> number of players yet to enter it
+
+    def start_rounds(self):
+        if self.rounds is not None:
+            self.num_rounds = self.rounds
+        else:
+            self.num_rounds = max(1, (len(self.players) - 1).bit_length())
+        for r in range(1, self.num_rounds + 1):
+            self.unentered[r] = len(self.players)
+        for user in list(self.players.values()):
+            self.played[user.uid] = set()
+            self.enter(user, 1)
+
+    def enter(self, user, round_):
+        if round_ > self.num_rounds:
+            self.release(user)
+            return
+        self.round_of[user.uid] = round_
+        played = self.played[user.uid]
+        bucket = self.waiting.setdefault(round_, {}).setdefault(self.points[user.uid], [])
+        for i, opponent in enumerate(bucket):
+            if opponent.uid not in played:
+                del bucket[i]
+                self.pair(round_, opponent, user)
+                break
+        else:
+            bucket.append(user)
+        self.entered(round_)
+
+    def entered(self, round_):
+        self.unentered[round_] -= 1
+        if self.unentered[round_] == 0:
+            self.flush(round_)
+
+    # Pair everyone still waiting in a round that nobody else can enter
+    def flush(self, round_):
+        buckets = self.waiting.pop(round_, {})
+        # Worst first, so that the best are popped off the end
+        leftover = [user for points in sorted(buckets)
+                    for user in reversed(buckets[points])]
+        while len(leftover) >= 2:
+            user = leftover.pop()
+            played = self.played[user.uid]
+            for i in range(len(leftover) - 1, -1, -1):
+                if leftover[i].uid not in played:
+                    break
+            else:
+                i = len(leftover) - 1
+            self.pair(round_, user, leftover.pop(i))
+        if leftover:
+            user = leftover[0]
+            logger.info(f'{self}: {user} gets a bye in round {round_}')
+            self.add_points(user, 1)
+            self.enter(user, round_ + 1)
+
+    def pair(self, round_, u1, u2):
+        self.played[u1.uid].add(u2.uid)
+        self.played[u2.uid].add(u1.uid)
+        match = Match(self, round_)
+        self.assign(match, u1)
+        self.assign(match, u2)
+
+    # Players who dropped or did not show up are taken out of the remaining
+    # rounds, rather than left to forfeit each of them in turn
+    def advance(self, match, winner, losers):
+        for user in [winner] + losers:
+            if user is None:
+                continue
+            if user.dropped or user in match.no_shows:
+                self.drop_out(user)
+            else:
+                self.enter(user, match.round + 1)
+
+    def drop_out(self, user):
+        round_ = self.round_of.pop(user.uid, None)
+        if round_ is not None:
+            bucket = self.waiting.get(round_, {}).get(self.points[user.uid], [])
+            if user in bucket:
+                bucket.remove(user)
+            # The user has already entered round_, but will not enter the
+            # rounds after it
+            for r in range(round_ + 1, self.num_rounds + 1):
+                self.entered(r)
+        super().drop_out(user)
+
+
+# Send a message to a user, deferred until they stand by if need be, since
+# mid-game the session only listens for the game's own commands
+def notify(user, message):
+    if user.dropped or user.affiliation is not None:
+        return
+    if user.standing_by:
+        user.queue.put_nowait({'action': 'notify', 'message': message})
+    else:
+        user.notices.append(message)
+
+
+async def user_session_tournament(ws, me, resp):
+    action = resp['action']
+    name = resp.get('tournament')
+    reply = {'action': action, 'tournament': name}
+    if isinstance(name, str) and name:
+        tournament = tournaments.get(name)
+    else:
+        name = tournament = None
+
+    if name is None:
+        reason = 'invalid name'
+    elif action == 'tournament_create':
+        fmt = resp.get('format', 'knockout')
+        rounds = resp.get('rounds')
+        if tournament is not None:
+            reason = 'name taken'
+        elif fmt == 'knockout':
+            tournament = tournaments[name] = KnockoutTournament(name, me)
+            reason = None
+        elif fmt == 'swiss' and (rounds is None or isinstance(rounds, int) and rounds > 0):
+            tournament = tournaments[name] = SwissTournament(name, me, rounds)
+            reason = None
+        else:
+            reason = 'invalid format'
+        if reason is None:
+            logger.info(f'{me} created {tournament}')
+    elif tournament is None:
+        reason = 'not found'
+    elif action == 'tournament_join':
+        reason = None if tournament.join(me) else 'unavailable'
+    elif tournament.organizer != me:
+        reason = 'not organizer'
+    else:
+        reason = None if tournament.start() else 'unavailable'
+
+    if reason is not None:
+        logger.info(f'{me}: {action} "{name}" failed: {reason}')
+        reply['action'] = 'tournament_failed'
+        reply['request'] = action
+        reply['reason'] = reason
+    await send_message(ws, reply, raise_exceptions=False, msg_prefix=me)
+
+
+# Report a finished game to its tournament, if any
+def game_ended(game):
+    if game.match is not None:
+        game.match.tournament.record(game)
+
+
 def sslcontext():
     if not ENABLE_SSL:
         return None
@@ -710,11 +1517,24 @@ def sslcontext():
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true')
+    parser.add_argument('--seed', type=int,
+                        help='seed bot moves and names, making replays deterministic')
     args = parser.parse_args()
 
     if args.debug:
         logger.setLevel(logging.DEBUG)
 
+    global SEED
+    if args.seed is not None:
+        SEED = args.seed
+    elif ENABLE_CAPTURE:
+        SEED = random.randrange(2 ** 32)
+    if SEED is not None:
+        logger.info(f'bot randomness seeded with {SEED}')
+
+    if ENABLE_CAPTURE:
+        setup_capture()
+
     ev.run_until_complete(websockets.serve(user_session, '0.0.0.0', PORT, ssl=sslcontext()))
     asyncio.ensure_future(matchmaker(), loop=ev)
     asyncio.ensure_future(judge(), loop=ev)
@@ -235,6 +235,10 @@ $(function () {
   ws.onmessage = function (ev) {
     var data = JSON.parse(ev.data)
     switch (data.action) {
+      case 'logon':
+        // The assigned uid is only needed by clients issuing challenges
+        break
+
       case 'match':
         them = data.opponent
         if ($gameContainer.is(':visible')) {